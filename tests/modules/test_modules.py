@@ -1,3 +1,4 @@
+import io
 import torch
 import pytest
 import pytorch_tools as pt
@@ -150,3 +151,215 @@ def test_space2depth():
     out2 = s2d_2(inp)
     expected2 = torch.tensor([[[[0, 2], [8, 10]], [[1, 3], [9, 11]], [[4, 6], [12, 14]], [[5, 7], [13, 15]]]])
     assert torch.allclose(out2, expected2)
+
+
+def test_channels_last():
+    """Check that blocks preserve channels last memory format and give the same output"""
+    block = modules.residual.InvertedResidual(16, 16, expand_ratio=4, attn_type="eca").eval()
+    inp = torch.rand(2, 16, 8, 8)
+    out = block(inp)
+    block = modules.residual.convert_channels_last(block)
+    out_cl = block(inp.to(memory_format=torch.channels_last))
+    assert out_cl.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(out, out_cl, atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "block_fn, out_ch",
+    [("BasicBlock", 16), ("Bottleneck", 4), ("InvertedResidual", 16), ("DepthwiseSeparableConv", 16)],
+)
+def test_fuse_for_inference(block_fn, out_ch):
+    """Check that folding BN into conv doesn't change output"""
+    kwargs = {} if block_fn == "DepthwiseSeparableConv" else dict(attn_type="se")
+    block = modules.residual.__dict__[block_fn](16, out_ch, **kwargs)
+    for m in block.modules():
+        if isinstance(m, modules.ABN):  # make BN stats non trivial
+            m.running_mean.uniform_(-1, 1)
+            m.running_var.uniform_(0.5, 2)
+            m.bias.data.uniform_(-1, 1)
+    block.eval()
+    inp = torch.rand(2, 16, 8, 8)
+    out = block(inp)
+    out_fused = block.fuse_for_inference()(inp)
+    assert not any(isinstance(m, modules.ABN) for m in block.modules())
+    assert torch.allclose(out, out_fused, atol=1e-5)
+
+
+def test_fuse_channels_last():
+    """Check that folding BN into conv keeps channels last weights"""
+    block = modules.residual.convert_channels_last(modules.residual.BasicBlock(16, 16)).eval()
+    inp = torch.rand(2, 16, 8, 8).to(memory_format=torch.channels_last)
+    out = block(inp)
+    block.fuse_for_inference()
+    assert block.conv1.weight.is_contiguous(memory_format=torch.channels_last)
+    assert block(inp).is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(block(inp), out, atol=1e-5)
+
+
+def test_drop_connect():
+    """Check that DropConnect drops whole samples and keeps expected value"""
+    l = modules.residual.DropConnect(0.5)
+    inp = torch.ones(1000, 2, 3, 3)
+    out = l(inp)
+    assert set(out.unique().tolist()) == {0.0, 2.0}
+    assert torch.all(out.view(1000, -1).min(1)[0] == out.view(1000, -1).max(1)[0])
+    assert abs(out.mean().item() - 1) < 0.2
+    assert torch.equal(l.eval()(inp), inp)
+
+
+@pytest.mark.parametrize("stage_fn", ["SimpleStage", "CrossStage"])
+def test_stage_checkpointing(stage_fn):
+    """Check that gradient checkpointing gives the same output and gradients"""
+    stage_fn = modules.residual.__dict__[stage_fn]
+    kwargs = dict(in_chs=16, out_chs=32, num_blocks=4, block_fn=modules.residual.SimpleBottleneck)
+    torch.manual_seed(42)
+    stage = stage_fn(**kwargs)
+    stage_ckpt = stage_fn(**kwargs, checkpoint_segments=2)
+    stage_ckpt.load_state_dict(stage.state_dict())
+    inp = torch.rand(2, 16, 16, 16)
+    out = stage(inp)
+    out_ckpt = stage_ckpt(inp)
+    assert torch.allclose(out, out_ckpt, atol=1e-6)
+    out.sum().backward()
+    out_ckpt.sum().backward()
+    for p, p_ckpt in zip(stage.parameters(), stage_ckpt.parameters()):
+        assert torch.allclose(p.grad, p_ckpt.grad, atol=1e-5)
+
+
+@pytest.mark.parametrize("attn_type", ["se", "eca", "sse", "scse", "scse-scalar"])
+def test_attention_channels_last(attn_type):
+    """Check that attention modules give the same result for NCHW and NHWC inputs"""
+    attn = modules.residual.get_attn(attn_type)(16, 4)
+    inp = torch.rand(2, 16, 8, 8)
+    out = attn(inp)
+    out_cl = attn(inp.to(memory_format=torch.channels_last))
+    assert torch.allclose(out, out_cl, atol=1e-6)
+
+
+def test_scse_no_cat():
+    """Check that SCSE without concatenation is equal to conv over concatenated sSE and cSE"""
+    attn = modules.residual.SCSEModule(16)
+    inp = torch.rand(2, 16, 8, 8)
+    expected = attn.reduction_conv(torch.cat([attn.sse(inp), attn.cse(inp)], dim=1))
+    assert torch.allclose(attn(inp), expected, atol=1e-6)
+
+
+def test_drop_connect_residual():
+    """Check that DropConnect with residual is equal to DropConnect + residual"""
+    l = modules.residual.DropConnect(0.5)
+    inp, residual = torch.rand(8, 2, 3, 3), torch.rand(8, 2, 3, 3)
+    torch.manual_seed(42)
+    expected = l(inp) + residual
+    torch.manual_seed(42)
+    assert torch.allclose(l(inp, residual), expected)
+    assert torch.allclose(l.eval()(inp, residual), inp + residual)
+    assert torch.allclose(modules.residual.DropConnect(1).train()(inp, residual), inp + residual)
+
+
+@pytest.mark.parametrize("csp_block_ratio", [0.5, 0.75])
+def test_cross_stage_split(csp_block_ratio):
+    """Check that only last `csp_block_ratio` part of channels is passed through blocks"""
+    stage = modules.residual.CrossStage(
+        16, 32, num_blocks=2, block_fn=modules.residual.SimpleBottleneck, csp_block_ratio=csp_block_ratio
+    ).eval()
+    inp = torch.rand(2, 16, 16, 16)
+    x = stage.first_layer(inp)
+    block_chs = int(32 * csp_block_ratio)
+    expected = torch.cat([x[:, :-block_chs], stage.x2_transition(stage.blocks(x[:, -block_chs:]))], dim=1)
+    assert torch.allclose(stage(inp), expected, atol=1e-6)
+
+
+@pytest.mark.skipif("fbgemm" not in torch.backends.quantized.supported_engines, reason="fbgemm is not available")
+@pytest.mark.parametrize("attn_type", [None, "se", "scse"])
+def test_quantize_for_inference(attn_type):
+    """Check that quantized block gives output close to the float one"""
+    block = modules.residual.InvertedResidual(16, 16, expand_ratio=4, attn_type=attn_type).eval()
+    calibration_data = [torch.rand(2, 16, 16, 16) for _ in range(4)]
+    out = block(calibration_data[0])
+    q_block = modules.residual.quantize_for_inference(block, calibration_data)
+    q_out = q_block(calibration_data[0])
+    assert (out - q_out).abs().max() < 0.1 * out.abs().max()
+
+
+@pytest.mark.parametrize("block_fn, out_ch", [("BasicBlock", 16), ("Bottleneck", 4)])
+def test_antialias_block(block_fn, out_ch):
+    """Check that antialiased blocks downsample input"""
+    downsample = torch.nn.AvgPool2d(2)
+    block = modules.residual.__dict__[block_fn](16, out_ch, stride=2, downsample=downsample, antialias=True)
+    assert isinstance(block.blurpool, modules.BlurPool)
+    assert block(torch.rand(2, 16, 8, 8)).shape == (2, 16, 4, 4)
+
+
+@pytest.mark.parametrize("kernel_size", [3, 9])
+def test_eca_shift_add(kernel_size):
+    """Check that shift-add in ECA is equal to Conv1d"""
+    attn = modules.residual.ECAModule(kernel_size=kernel_size)
+    inp = torch.rand(2, 16, 8, 8)
+    x_s = attn.conv(inp.mean(dim=(2, 3)).unsqueeze(1)).view(2, 16, 1, 1)
+    assert torch.allclose(attn(inp), inp * x_s.sigmoid(), atol=1e-6)
+    assert torch.allclose(torch.jit.script(attn)(inp), attn(inp), atol=1e-6)
+
+
+def test_compile_blocks():
+    """Check that only the outermost blocks are compiled and output doesn't change"""
+    model = torch.nn.Sequential(
+        modules.residual.InvertedResidual(16, 16, expand_ratio=4, attn_type="se"),
+        modules.residual.SimpleSeparable_2(16, 16, 16),
+    ).eval()
+    inp = torch.rand(2, 16, 8, 8)
+    out = model(inp)
+    model = modules.residual.compile_blocks(model, mode=None, backend="eager")
+    assert model[0]._compiled_call_impl is not None and model[1]._compiled_call_impl is not None
+    assert model[1].sep_convs[0]._compiled_call_impl is None
+    assert torch.allclose(model(inp), out)
+    # compiled model could still be saved
+    buffer = io.BytesIO()
+    torch.save(model, buffer)
+    # root module is compiled if it's a block
+    block = modules.residual.compile_blocks(modules.residual.BasicBlock(16, 16), mode=None, backend="eager")
+    assert block._compiled_call_impl is not None
+
+
+def test_scse_scalar_reduction():
+    """Check that scalar reduction in SCSE is a sum of sSE and cSE"""
+    attn = modules.residual.get_attn("scse-scalar")(16, 4)
+    assert not hasattr(attn, "reduction_conv")
+    inp = torch.rand(2, 16, 8, 8)
+    assert torch.allclose(attn(inp), attn.sse(inp) + attn.cse(inp))
+    for reduction in ["conv", "scalar"]:
+        attn = modules.residual.SCSEModule(16, reduction=reduction)
+        assert torch.allclose(torch.jit.script(attn)(inp), attn(inp), atol=1e-6)
+    with pytest.raises(ValueError):
+        modules.residual.SCSEModule(16, reduction="wrong")
+
+
+def test_se_linear():
+    """Check that SE with linear layers is equal to SE with 1x1 convs"""
+    attn = modules.SEModule(16, 4)
+    inp = torch.rand(2, 16, 8, 8)
+    x_se = attn.fc2(attn.act1(attn.fc1(inp.mean(dim=(2, 3), keepdim=True))))
+    assert torch.allclose(attn(inp), inp * x_se.sigmoid(), atol=1e-6)
+
+
+@pytest.mark.parametrize("block_fn", ["DarkBasicBlock", "CSPDarkBasicBlock"])
+def test_dark_blocks(block_fn):
+    """Check that DarkNet blocks could be created and BN in DarkBasicBlock is used"""
+    block = modules.residual.__dict__[block_fn](64, 64)
+    inp = torch.rand(2, 64, 8, 8)
+    assert block(inp).shape == inp.shape
+    if block_fn == "DarkBasicBlock":
+        out = block.eval()(inp)
+        block.bn1.bias.data.fill_(10)
+        assert not torch.allclose(block(inp), out)
+
+
+def test_residual_chosen_at_init():
+    """Check that residual sum is chosen in `__init__` and only applied when shapes match"""
+    block = modules.residual.SimpleBottleneck(16, 8, 16).eval()
+    assert isinstance(block.residual_add, modules.residual.DropConnect)
+    inp = torch.rand(2, 16, 8, 8)
+    out = block.bn3(block.conv3(block.bn2(block.conv2(block.bn1(block.conv1(inp))))))
+    assert torch.allclose(block(inp), out + inp)
+    block = modules.residual.InvertedResidual(16, 16, noskip=True, keep_prob=0.5)
+    assert isinstance(block.drop_connect, modules.residual.NoResidual)
+    assert block(inp).shape == inp.shape